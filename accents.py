@@ -0,0 +1,35 @@
+from typing import Dict
+import json
+import re
+
+
+class AccentNormaliser:
+    """
+    Replaces the accents split from their letters by the PDF text extraction, such as "´e", by the accented letters,
+    in lowercase and uppercase. Single characters go through a translation table and longer sequences through one
+    compiled alternation, so a string is copied at most twice whatever the size of the table.
+    """
+
+    def __init__(self, accents: Dict[str, str]):
+        # Same priority as replacing the pairs one after the other: the first pair matching a sequence wins
+        self.replacements: Dict[str, str] = {}
+        for a, b in accents.items():
+            self.replacements.setdefault(a, b)
+            self.replacements.setdefault(a.upper(), b.upper())
+
+        self.table = str.maketrans({a: b for a, b in self.replacements.items() if len(a) == 1})
+
+        sequences = sorted((a for a in self.replacements if len(a) > 1), key=len, reverse=True)
+        self.pattern = re.compile("|".join(map(re.escape, sequences))) if len(sequences) > 0 else None
+
+    def __call__(self, text: str) -> str:
+        if len(self.table) > 0:
+            text = text.translate(self.table)
+        if self.pattern is not None:
+            text = self.pattern.sub(lambda m: self.replacements[m.group()], text)
+        return text
+
+
+def load_normaliser(path) -> AccentNormaliser:
+    with open(path) as f:
+        return AccentNormaliser(json.load(f))
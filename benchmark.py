@@ -0,0 +1,387 @@
+from typing import Callable, Dict, List, Tuple
+from pathlib import Path
+import contextlib
+import filecmp
+import platform
+import shutil
+import glob
+import io
+import json
+import os
+import random
+import re
+import tempfile
+import time
+
+from accents import load_normaliser
+from bs4 import BeautifulSoup
+from geojson import Feature, Point
+from Levenshtein import distance
+
+from conference import Conference, extract_paper
+from context import CONTEXT
+from metadata import read_reference
+from paper import assign_closest
+import extractor
+
+
+RESULTS = "output/benchmark.json"
+BASELINE = "output/benchmark_baseline.json"
+
+
+@contextlib.contextmanager
+def quiet():
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+
+def timeit(function: Callable, inputs: List, repeat=3) -> float:
+    # Best total time over a few runs, in seconds
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for i in inputs:
+            function(*i)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def get_affiliation_lines() -> List[str]:
+    lines = []
+    for path in sorted(glob.glob("output/*/general.json")):
+        with open(path) as f:
+            for paper in json.load(f).values():
+                for labs in paper["authors"].values():
+                    lines += labs
+    return sorted(set(lines))
+
+
+def get_author_lines() -> List[Tuple[str, str]]:
+    # Authors lines as they appear in papers (names followed by affiliation symbols), with their authors
+    random.seed(0)
+    cases = []
+    for path in sorted(glob.glob("data/papers/*.json") + glob.glob("output/*/general.json")):
+        with open(path) as f:
+            for paper in json.load(f).values():
+                authors = list(paper["authors"].keys())
+                line = ", ".join(f"{author}{random.randint(1, 3)}" for author in authors)
+                cases += [(line, author) for author in authors]
+    return cases
+
+
+def get_establishment_lines() -> List[str]:
+    # Affiliations lines as they appear in papers (affiliation symbols followed by labs), one per paper
+    lines = []
+    for path in sorted(glob.glob("data/papers/*.json") + glob.glob("output/*/general.json")):
+        with open(path) as f:
+            for paper in json.load(f).values():
+                labs = list(dict.fromkeys(lab for labs in paper["authors"].values() for lab in labs))
+                lines.append(" ".join(f"{i + 1}{lab}" for i, lab in enumerate(labs)))
+    return lines
+
+
+def legacy_get_postal_codes(line):
+    matches = []
+    for country, r in CONTEXT.get_json(extractor.POSTAL_CODES_PATH).items():
+        if match := re.findall(r, line):
+            matches += match
+
+    matches = [m for m in matches if m != '' and not isinstance(m, tuple)]
+
+    return extractor.substring_sieve(matches)
+
+
+def benchmark_postal_codes() -> Dict:
+    lines = [(line,) for line in get_affiliation_lines()]
+
+    mismatches = [line for line, in lines if extractor.get_postal_codes(line) != legacy_get_postal_codes(line)]
+    legacy = timeit(legacy_get_postal_codes, lines)
+    compiled = timeit(extractor.get_postal_codes, lines)
+
+    return {"lines": len(lines), "mismatches": len(mismatches), "legacy_ms": legacy * 1000, "ms": compiled * 1000}
+
+
+def benchmark_affiliations() -> Dict:
+    lines = [(line,) for line in get_establishment_lines()]
+    return {"lines": len(lines), "ms": timeit(extractor.get_affiliations, lines) * 1000}
+
+
+def legacy_normalise(accents, esta):
+    for a, b in accents.items():
+        esta = esta.replace(a, b)
+        esta = esta.replace(a.upper(), b.upper())
+    return esta
+
+
+def benchmark_normalise(accents_path="data/accents.json") -> Dict:
+    accents = CONTEXT.get_json(accents_path)
+    normalise = load_normaliser(accents_path)
+
+    # The affiliations as extracted, with their accents split back from their letters
+    split = {b: a for a, b in accents.items()} | {b.upper(): a.upper() for a, b in accents.items()}
+    lines = [(legacy_normalise(split, line),) for line in get_affiliation_lines()]
+
+    mismatches = [line for line, in lines if normalise(line) != legacy_normalise(accents, line)]
+    legacy = timeit(legacy_normalise, [(accents, line) for line, in lines])
+    compiled = timeit(normalise, lines)
+
+    return {"lines": len(lines), "mismatches": len(mismatches), "legacy_ms": legacy * 1000, "ms": compiled * 1000}
+
+
+def legacy_find_approximate_substring(line, substring):
+    distances = [(i, distance(line[i:i+len(substring)], substring)) for i in range(0, len(line) - len(substring) + 1)]
+    closest = min(distances, key=lambda x: x[1])[0]
+    return closest
+
+
+def benchmark_approximate_substring() -> Dict:
+    cases = get_author_lines()
+
+    mismatches = [c for c in cases if extractor.find_approximate_substring(*c) != legacy_find_approximate_substring(*c)]
+    legacy = timeit(legacy_find_approximate_substring, cases)
+    batched = timeit(extractor.find_approximate_substring, cases)
+
+    return {"authors": len(cases), "mismatches": len(mismatches), "legacy_ms": legacy * 1000, "ms": batched * 1000}
+
+
+def legacy_fix_names(authors, reference):
+    output = []
+    for author in authors:
+        distances = [distance(author, r) for r in reference]
+        output.append(reference[distances.index(min(distances))])
+    return output
+
+
+def benchmark_assign_closest() -> Dict:
+    # Author names of each paper as extracted, with a few characters dropped, against the reference names
+    random.seed(0)
+    cases = []
+    for path in sorted(glob.glob("data/papers/*.json") + glob.glob("output/*/general.json")):
+        with open(path) as f:
+            for paper in json.load(f).values():
+                reference = list(paper["authors"].keys())
+                authors = ["".join(c for c in author if random.random() > 0.1) for author in reference]
+                cases.append((authors, reference))
+
+    # Papers where extracted names collapse onto the same reference name, which then fail
+    collisions = [case for case in cases if len(set(legacy_fix_names(*case))) < len(case[0])]
+    mismatches = [case for case in cases if case not in collisions and assign_closest(*case) != legacy_fix_names(*case)]
+    legacy = timeit(legacy_fix_names, cases)
+    batched = timeit(assign_closest, cases)
+
+    return {
+        "papers": len(cases),
+        "collisions": len(collisions),
+        "resolved": sum(len(set(assign_closest(*case))) == len(case[0]) for case in collisions),
+        "mismatches": len(mismatches),
+        "legacy_ms": legacy * 1000,
+        "ms": batched * 1000,
+    }
+
+
+def legacy_read_reference(page):
+    soup = BeautifulSoup(page, "html.parser")
+
+    authors = [" ".join(meta["content"].split(",")[::-1]).strip() for meta in soup.findAll("meta", attrs={"name": "citation_author"})]
+    title = soup.findAll("meta", attrs={"name": "citation_title"})[0]["content"]
+
+    return authors, title
+
+
+def benchmark_read_reference() -> Dict:
+    pages = []
+    for path in sorted(glob.glob("data/papers/*/*.html")):
+        with open(path) as f:
+            pages.append((f.read(),))
+
+    mismatches = [page for page, in pages if read_reference(page) != legacy_read_reference(page)]
+    legacy = timeit(legacy_read_reference, pages)
+    head = timeit(read_reference, pages)
+
+    return {"pages": len(pages), "mismatches": len(mismatches), "legacy_ms": legacy * 1000, "ms": head * 1000}
+
+
+def legacy_export_geojson(lab, path):
+    output = {
+        "type": "FeatureCollection",
+        "crs": {"type": "name", "properties": {"name": "urn:ogc:def:crs:OGC:1.3:CRS84"}},
+        "features": []
+    }
+    for row in lab.existing.drop_nulls().rows():
+        coordinates = [float(row[2]), float(row[1])]
+        if coordinates == [0.0, 0.0]:
+            continue
+
+        papers = []
+        for paper_id, paper in lab.affiliations.items():
+            authors_at_location = [author for author, aff in paper["authors"].items() if row[0] in aff]
+            if len(authors_at_location) > 0:
+                papers.append({
+                    "url": paper["url"],
+                    "title": paper["title"],
+                    "authors": [f"<strong>{author}</strong>" if author in authors_at_location else author
+                                for author in paper["authors"].keys()],
+                })
+
+        if len(papers) > 0:
+            output["features"].append(
+                Feature(geometry=Point(coordinates), properties={"title": row[0], "papers": papers})
+            )
+
+    with open(path, "w+") as f:
+        json.dump(output, f)
+
+
+def benchmark_export_geojson(name) -> Dict:
+    from laboratory import Laboratory
+
+    lab = Laboratory(Conference(name))
+
+    with tempfile.TemporaryDirectory() as folder:
+        lab.coordinates = f"{folder}/indexed.geojson"
+        with quiet():
+            indexed = timeit(lab.export_geojson, [()], repeat=1)
+            legacy = timeit(legacy_export_geojson, [(lab, f"{folder}/legacy.geojson")], repeat=1)
+
+        same = filecmp.cmp(f"{folder}/indexed.geojson", f"{folder}/legacy.geojson", shallow=False)
+
+    return {"identical": same, "legacy_ms": legacy * 1000, "ms": indexed * 1000}
+
+
+def benchmark_lab_export(name) -> Dict:
+    from laboratory import Laboratory
+
+    lab = Laboratory(Conference(name))
+    correct_output = Laboratory.CORRECT_OUTPUT
+
+    # Appending the new labs to a copy of the locations table
+    with tempfile.TemporaryDirectory() as folder:
+        Laboratory.CORRECT_OUTPUT = shutil.copy(correct_output, f"{folder}/locations.csv")
+        try:
+            elapsed = timeit(lab.export, [()], repeat=1)
+        finally:
+            Laboratory.CORRECT_OUTPUT = correct_output
+
+    return {"labs": len(lab.existing), "ms": elapsed * 1000}
+
+
+def benchmark_group_lab_names(name) -> Dict:
+    from laboratory import Laboratory
+
+    lab = Laboratory(Conference(name))
+    distances, groups = Laboratory.DISTANCES, Laboratory.GROUPS
+
+    # Building the distance matrix from scratch, without touching the cached one, with every pair sharing a name part
+    # and with the pairs within epsilon only
+    with tempfile.TemporaryDirectory() as folder:
+        Laboratory.GROUPS = f"{folder}/groups.csv"
+        try:
+            with quiet():
+                Laboratory.DISTANCES = f"{folder}/distances.npz"
+                elapsed = timeit(lab.group_lab_names, [()], repeat=1)
+                Laboratory.DISTANCES = f"{folder}/radius.npz"
+                radius = timeit(lab.group_lab_names, [(0.3, 0.3)], repeat=1)
+        finally:
+            Laboratory.DISTANCES, Laboratory.GROUPS = distances, groups
+
+    return {"labs": lab.existing.get_column("Lab").n_unique(), "ms": elapsed * 1000, "radius_ms": radius * 1000}
+
+
+def benchmark_extraction(name) -> Dict:
+    """
+    Extraction throughput over the papers already downloaded to data/papers/{name}/, and accuracy against the manual
+    transcriptions of data/papers/{name}.json for the papers having both.
+    """
+    conference = Conference(name)
+    papers = [
+        (paper_id, link) for paper_id, link in conference.links.items()
+        if Path(f"{conference.papers_path}{paper_id}.pdf").exists() and Path(f"{conference.papers_path}{paper_id}.html").exists()
+    ]
+
+    elapsed, errors = 0.0, 0
+    manual_papers, exact_papers, manual_authors, exact_authors = 0, 0, 0, 0
+    for paper_id, link in papers:
+        start = time.perf_counter()
+        with quiet():
+            _, paper, error, _ = extract_paper((name, paper_id, link, False))
+        elapsed += time.perf_counter() - start
+
+        errors += error is not None
+
+        if paper_id not in conference.manual:
+            continue
+
+        expected = conference.manual[paper_id]["authors"]
+        extracted = conference.clean(paper)["authors"] if paper is not None else {}
+
+        manual_papers += 1
+        exact_papers += extracted == expected
+        manual_authors += len(expected)
+        exact_authors += sum(extracted.get(author) == labs for author, labs in expected.items())
+
+    return {
+        "papers": len(papers),
+        "errors": errors,
+        "seconds": elapsed,
+        "papers_per_second": len(papers) / elapsed if elapsed > 0 else None,
+        "manual_papers": manual_papers,
+        "paper_accuracy": exact_papers / manual_papers if manual_papers > 0 else None,
+        "author_accuracy": exact_authors / manual_authors if manual_authors > 0 else None,
+    }
+
+
+def compare(results: Dict, baseline: Dict, tolerance=0.1):
+    # Timings more than `tolerance` slower, and accuracies lower, than in the baseline
+    for name, metrics in results["benchmarks"].items():
+        for metric, value in metrics.items():
+            previous = baseline.get("benchmarks", {}).get(name, {}).get(metric)
+            if not isinstance(value, float) or not isinstance(previous, float):
+                continue
+
+            if metric in ("ms", "radius_ms", "seconds") and value > previous * (1 + tolerance):
+                print(f"REGRESSION: {name}.{metric} {previous:.1f} -> {value:.1f}")
+            elif metric.endswith("accuracy") and value < previous:
+                print(f"REGRESSION: {name}.{metric} {previous:.3f} -> {value:.3f}")
+
+
+def run(conferences=("interspeech23", "interspeech24")) -> Dict:
+    benchmarks = {
+        "get_postal_codes": benchmark_postal_codes(),
+        "get_affiliations": benchmark_affiliations(),
+        "find_approximate_substring": benchmark_approximate_substring(),
+        "read_reference": benchmark_read_reference(),
+        "normalise": benchmark_normalise(),
+        "assign_closest": benchmark_assign_closest(),
+    }
+
+    for name in conferences:
+        benchmarks[f"extraction/{name}"] = benchmark_extraction(name)
+        benchmarks[f"export_geojson/{name}"] = benchmark_export_geojson(name)
+        benchmarks[f"lab_export/{name}"] = benchmark_lab_export(name)
+
+    benchmarks["group_lab_names"] = benchmark_group_lab_names(conferences[0])
+
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "benchmarks": benchmarks,
+    }
+
+
+if __name__ == '__main__':
+    import sys
+
+    results = run(tuple(sys.argv[1:]) or ("interspeech23", "interspeech24"))
+    print(json.dumps(results, indent=4))
+
+    with open(RESULTS, "w+") as f:
+        json.dump(results, f, indent=4)
+
+    # Copy a results file to the baseline path to compare the next runs against it
+    if Path(BASELINE).exists():
+        with open(BASELINE) as f:
+            compare(results, json.load(f))
@@ -0,0 +1,69 @@
+from typing import Dict, Optional, Tuple
+from pathlib import Path
+import hashlib
+import json
+import os
+
+from context import CONTEXT
+from extractor import EXTRACTOR_VERSION, POSTAL_CODES_PATH
+from paper import write_atomic
+
+
+def hash_file(path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ExtractionCache:
+    """
+    Extraction results stored on disk, one file per result, named after the hash of everything the result depends
+    on: the pdf file, the html page, the extractor version, the accents table and the postal codes.
+    """
+
+    def __init__(self, folder, accents_path, postal_codes_path=POSTAL_CODES_PATH):
+        self.folder = folder
+        Path(self.folder).mkdir(parents=True, exist_ok=True)
+
+        self.accents_hash = CONTEXT.load(accents_path, hash_file)
+        self.postal_codes_hash = CONTEXT.load(postal_codes_path, hash_file)
+
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, pdf_path, html_path) -> Optional[str]:
+        # Nothing is cached for papers that still need to be downloaded
+        if not os.path.exists(pdf_path) or not os.path.exists(html_path):
+            return None
+
+        h = hashlib.sha256()
+        for part in [hash_file(pdf_path), hash_file(html_path), str(EXTRACTOR_VERSION), self.accents_hash,
+                     self.postal_codes_hash]:
+            h.update(part.encode())
+        return h.hexdigest()
+
+    def get(self, key: Optional[str]) -> Optional[Tuple[Optional[Dict], Optional[str]]]:
+        path = f"{self.folder}{key}.json"
+        if key is None or not os.path.exists(path):
+            self.misses += 1
+            return None
+
+        with open(path) as f:
+            data = json.load(f)
+
+        self.hits += 1
+        return data["paper"], data["error"]
+
+    def put(self, key: Optional[str], paper: Optional[Dict], error: Optional[str]):
+        if key is None:
+            return
+
+        write_atomic(f"{self.folder}{key}.json", json.dumps({"paper": paper, "error": error}).encode())
+
+    def invalidate(self):
+        for path in Path(self.folder).glob("*.json"):
+            os.remove(path)
+        self.hits = 0
+        self.misses = 0
@@ -0,0 +1,197 @@
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import json
+import re
+
+from scipy import sparse
+import numpy as np
+import polars as pl
+
+from conference import Conference
+from context import CONTEXT, read_json
+
+
+CONFERENCE = re.compile(r"^(?P<series>.*?)(?P<year>\d{2}|\d{4})$")
+
+COUNTRIES_PATH = "data/countries.json"
+
+
+def get_series(conference) -> Tuple[str, int]:
+    # "interspeech23" -> ("interspeech", 2023)
+    match = CONFERENCE.match(conference)
+    if match is None:
+        return conference, 0
+    year = int(match.group("year"))
+    return match.group("series"), year + 2000 if year < 100 else year
+
+
+def get_country_key(name) -> str:
+    key = " ".join(name.lower().replace(".", "").split())
+    return key[4:] if key.startswith("the ") else key
+
+
+def load_countries(path) -> Dict[str, str]:
+    # Country of each of the names and aliases in the file
+    countries = {}
+    for country, aliases in read_json(path).items():
+        for alias in [country] + aliases:
+            countries[get_country_key(alias)] = country
+    return countries
+
+
+def get_country(lab, countries: Dict[str, str]) -> Optional[str]:
+    # Country the last part of the affiliation names, or ends with ("CB2 1PZ UK"), None when it names none
+    tail = lab.split(",")[-1].strip(" ;.-()")
+    if (country := countries.get(get_country_key(tail))) is not None:
+        return country
+
+    words = tail.split()
+    for n in range(min(3, len(words) - 1), 0, -1):
+        # Not in names such as "University of Chile", and short codes only in capitals, unlike "in" or "me"
+        if words[-n - 1].lower() == "of" or (len(words[-n]) <= 3 and not words[-n].isupper()):
+            continue
+        if (country := countries.get(get_country_key(" ".join(words[-n:])))) is not None:
+            return country
+
+    return None
+
+
+def get_previous(conferences: List[str]) -> np.ndarray:
+    # Index of the latest earlier conference of the same series, -1 for the first one
+    series = [get_series(name) for name in conferences]
+    previous = []
+    for name, year in series:
+        earlier = [c for c, (other, other_year) in enumerate(series) if other == name and other_year < year]
+        previous.append(max(earlier, key=lambda c: series[c][1]) if len(earlier) > 0 else -1)
+    return np.array(previous, dtype=np.int64)
+
+
+def get_indicator(keys: List, values: List) -> sparse.csr_matrix:
+    # keys x distinct values matrix, with a one at the value of each key, and an empty row for keys without a value
+    columns = {value: j for j, value in enumerate(dict.fromkeys(v for v in values if v is not None))}
+    rows = [i for i, v in enumerate(values) if v is not None]
+    return sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.int32), (rows, [columns[values[i]] for i in rows])),
+        shape=(len(keys), len(columns)),
+    )
+
+
+class Collaborations:
+    """
+    Collaborations between labs over several conferences, from their merged affiliations. Papers are indexed once
+    into a sparse papers x labs incidence matrix, from which every count is computed with sparse products.
+    """
+
+    FOLDER = "output/collaborations/"
+
+    def __init__(self, conferences: List[str]):
+        # Grouped by series, then ordered by year
+        self.conferences = sorted(conferences, key=get_series)
+
+        self.labs: Dict[str, int] = {}
+        self.papers: List[Tuple[str, str]] = []
+        rows, columns, paper_conferences = [], [], []
+        for c, name in enumerate(self.conferences):
+            for paper_id, paper in Conference(name).get_merged_affiliations().items():
+                for lab in dict.fromkeys(lab for labs in paper["authors"].values() for lab in labs):
+                    rows.append(len(self.papers))
+                    columns.append(self.labs.setdefault(lab, len(self.labs)))
+                self.papers.append((name, paper_id))
+                paper_conferences.append(c)
+
+        self.incidence = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.int32), (rows, columns)), shape=(len(self.papers), len(self.labs))
+        )
+
+        # conferences x papers, and labs x countries
+        self.conference_papers = sparse.csr_matrix(
+            (np.ones(len(self.papers), dtype=np.int32), (paper_conferences, np.arange(len(self.papers)))),
+            shape=(len(self.conferences), len(self.papers)),
+        )
+        countries = CONTEXT.load(COUNTRIES_PATH, load_countries)
+        lab_countries = [get_country(lab, countries) for lab in self.labs]
+        self.countries = list(dict.fromkeys(c for c in lab_countries if c is not None))
+        self.lab_countries = get_indicator(list(self.labs), lab_countries)
+        self.unresolved = [lab for lab, country in zip(self.labs, lab_countries) if country is None]
+
+        self.previous = get_previous(self.conferences)
+
+    def get_coauthorship(self) -> sparse.csr_matrix:
+        # labs x labs number of papers written together, without the diagonal (papers of each lab)
+        coauthorship = (self.incidence.T @ self.incidence).tocsr()
+        coauthorship.setdiag(0)
+        coauthorship.eliminate_zeros()
+        return coauthorship
+
+    def get_lab_counts(self) -> np.ndarray:
+        # conferences x labs number of papers
+        return (self.conference_papers @ self.incidence).toarray()
+
+    def get_country_counts(self) -> np.ndarray:
+        # conferences x countries number of papers with at least one of their labs in the country, labs without a
+        # known country left out
+        paper_countries = (self.incidence @ self.lab_countries) > 0
+        return (self.conference_papers @ paper_countries.astype(np.int32)).toarray()
+
+    def get_deltas(self, counts: np.ndarray) -> np.ndarray:
+        # Difference with the previous year of the same series, the counts themselves for the first year
+        previous = np.where((self.previous >= 0)[:, None], counts[self.previous], 0)
+        return counts - previous
+
+    def get_table(self, counts: np.ndarray, keys: List[str], key: str) -> pl.DataFrame:
+        deltas = self.get_deltas(counts)
+        conferences, columns = np.nonzero((counts != 0) | (deltas != 0))
+
+        # No delta for the first year of a series
+        series = [get_series(name) for name in self.conferences]
+        return pl.DataFrame({
+            "conference": [self.conferences[c] for c in conferences],
+            "series": [series[c][0] for c in conferences],
+            "year": [series[c][1] for c in conferences],
+            key: [keys[j] for j in columns],
+            "papers": counts[conferences, columns],
+            "delta": deltas[conferences, columns],
+            "first": self.previous[conferences] < 0,
+        }).with_columns(pl.when(pl.col("first")).then(None).otherwise(pl.col("delta")).alias("delta")).drop("first")
+
+    def get_lab_table(self) -> pl.DataFrame:
+        return self.get_table(self.get_lab_counts(), list(self.labs), "lab")
+
+    def get_country_table(self) -> pl.DataFrame:
+        return self.get_table(self.get_country_counts(), self.countries, "country")
+
+    def get_unresolved_table(self) -> pl.DataFrame:
+        # Labs whose country isn't known, with their number of papers over every conference
+        papers = np.asarray(self.incidence.sum(axis=0)).ravel()
+        return pl.DataFrame({
+            "lab": self.unresolved,
+            "papers": [papers[self.labs[lab]] for lab in self.unresolved],
+        }, schema={"lab": pl.String, "papers": pl.Int64}).sort("papers", "lab", descending=[True, False])
+
+    def get_pairs(self) -> pl.DataFrame:
+        # Pairs of labs having written papers together, the most frequent first
+        pairs = sparse.triu(self.get_coauthorship(), k=1).tocoo()
+        labs = list(self.labs)
+        return pl.DataFrame({
+            "lab": [labs[i] for i in pairs.row],
+            "other": [labs[j] for j in pairs.col],
+            "papers": pairs.data,
+        }).sort("papers", "lab", "other", descending=[True, False, False])
+
+    def export(self):
+        Path(Collaborations.FOLDER).mkdir(parents=True, exist_ok=True)
+
+        # Labs of the rows and columns of the matrix, in order
+        sparse.save_npz(f"{Collaborations.FOLDER}coauthorship.npz", self.get_coauthorship())
+        with open(f"{Collaborations.FOLDER}coauthorship_labs.json", "w+") as f:
+            json.dump(list(self.labs), f, indent=4)
+        self.get_pairs().write_csv(f"{Collaborations.FOLDER}pairs.csv")
+        self.get_lab_table().write_csv(f"{Collaborations.FOLDER}labs.csv")
+        self.get_country_table().write_csv(f"{Collaborations.FOLDER}countries.csv")
+        self.get_unresolved_table().write_csv(f"{Collaborations.FOLDER}unresolved_countries.csv")
+
+
+if __name__ == '__main__':
+    import sys
+
+    Collaborations(sys.argv[1:] or ["interspeech23", "interspeech24"]).export()
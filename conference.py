@@ -1,9 +1,57 @@
-import json
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import nullcontext
+from typing import Dict, Iterable, Optional, Tuple
 from pathlib import Path
+import cProfile
+import json
+import csv
+import os
 
 from tqdm import tqdm
+import polars as pl
 
+from accents import AccentNormaliser, load_normaliser
+from cache import ExtractionCache
+from context import CONTEXT
 from paper import Paper
+from profiling import Stages, get_rows, recording, stage, summarise
+
+
+def extract_paper(task: Tuple[str, str, str, bool]) -> Tuple[str, Optional[Dict], Optional[str], Optional[Stages]]:
+    # Runs in worker processes, so it only takes and returns picklable values
+    event, paper_id, link, profile = task
+
+    with recording() if profile else nullcontext() as stages:
+        try:
+            with stage("paper"):
+                paper = Paper(event, paper_id, link)
+        except Exception as e:
+            # raise e
+            return paper_id, None, str(e), stages
+
+    return paper_id, {
+        "url": paper.page_url,
+        "title": paper.title,
+        "authors": paper.authors_affiliations,
+    }, None, stages
+
+
+def get_tables(name, affiliations: Dict) -> Tuple[pl.DataFrame, pl.DataFrame]:
+    # One row per paper, and one row per author and lab (a null lab for authors without any)
+    papers = {"conference": [], "paper_id": [], "url": [], "title": []}
+    rows = {"conference": [], "paper_id": [], "author": [], "author_pos": [], "lab_pos": [], "lab": []}
+
+    for paper_id, paper in affiliations.items():
+        for column, value in zip(papers, (name, paper_id, paper["url"], paper["title"])):
+            papers[column].append(value)
+
+        for author_pos, (author, labs) in enumerate(paper["authors"].items()):
+            for lab_pos, lab in enumerate(labs or [None]):
+                for column, value in zip(rows, (name, paper_id, author, author_pos, lab_pos, lab)):
+                    rows[column].append(value)
+
+    return pl.DataFrame(papers, schema=Conference.PAPERS_SCHEMA), pl.DataFrame(rows, schema=Conference.AFFILIATIONS_SCHEMA)
+
 
 class Conference:
 
@@ -11,6 +59,12 @@ class Conference:
     CONFERENCES_DIR = "data/conferences/"
     OUTPUT_DIR = "output/"
 
+    PAPERS_SCHEMA = {"conference": pl.String, "paper_id": pl.String, "url": pl.String, "title": pl.String}
+    AFFILIATIONS_SCHEMA = {
+        "conference": pl.String, "paper_id": pl.String, "author": pl.String,
+        "author_pos": pl.Int32, "lab_pos": pl.Int32, "lab": pl.String,
+    }
+
     def __init__(self, name):
         self.name = name
         self.papers_path = f"{Conference.PAPERS_DIR}{name}/"
@@ -21,64 +75,88 @@ class Conference:
         Path(f"{Conference.OUTPUT_DIR}{name}/").mkdir(parents=True, exist_ok=True)
         self.output_path = f"{Conference.OUTPUT_DIR}{name}/general.json"
         self.errors_path = f"{Conference.OUTPUT_DIR}{name}/errors.json"
+        self.papers_table = f"{Conference.OUTPUT_DIR}{name}/papers.parquet"
+        self.affiliations_table = f"{Conference.OUTPUT_DIR}{name}/affiliations.parquet"
+        self.timings_path = f"{Conference.OUTPUT_DIR}{name}/timings"
+        self.cache = ExtractionCache(f"{Conference.OUTPUT_DIR}{name}/cache/", self.accents_path)
 
         Path(self.papers_path).mkdir(parents=True, exist_ok=True)
 
-        with open(self.manual_path, "r") as f:
-            self.manual = json.load(f)
-
-        with open(self.links_path) as f:
-            self.links = json.load(f)
-
-        with open(self.accents_path) as f:
-            self.accents = json.load(f)
+        self.manual = CONTEXT.get_json(self.manual_path)
+        self.links = CONTEXT.get_json(self.links_path)
+        self.normalise: AccentNormaliser = CONTEXT.load(self.accents_path, load_normaliser)
 
         self.correct_output = {}
         self.errors = {}
+        self.timings: Dict[str, Stages] = {}
 
-    def analyse(self, *args):
+    def analyse(self, *args, workers=1, use_cache=True, executor: Optional[Executor] = None, profile=False):
         limit = len(self.links) if len(args) == 0 or isinstance(args[0], str) else args[0]
         links = list(self.links.items())[:limit]
 
         if len(args) > 0 and isinstance(args[0], str):
             links = [(a, self.links[a]) for a in args]
 
-        for i, (paper_id, link) in (pbar := tqdm(enumerate(links), total=len(links))):
-            pbar.set_description(f"paper_id={paper_id}")
+        tasks = [(self.name, paper_id, link, profile) for paper_id, link in links if paper_id not in self.manual]
+
+        # Cached papers are never extracted, so profiling runs every paper
+        results = {}
+        if use_cache and not profile:
+            for _, paper_id, _, _ in tasks:
+                if (cached := self.cache.get(self.get_cache_key(paper_id))) is not None:
+                    results[paper_id] = cached
+
+        missing = [task for task in tasks if task[1] not in results]
 
-            if paper_id in self.manual:
-                continue
-
-            try:
-                paper = Paper(self.name, paper_id, link)
-            except Exception as e:
-                # raise e
-                k = str(e)
-                if k in self.errors:
-                    self.errors[k].append(paper_id)
-                else:
-                    self.errors[k] = [paper_id]
-                continue
-
-            self.correct_output[paper_id] = {}
-            for author, establishments in paper.authors_affiliations.items():
-                cleaned = []
-                for esta in establishments:
-                    for a, b in self.accents.items():
-                        esta = esta.replace(a, b)
-                        esta = esta.replace(a.upper(), b.upper())
-
-                    cleaned.append(esta)
-                self.correct_output[paper_id][author] = cleaned
-
-            self.correct_output[paper_id] = {
-                "url": paper.page_url,
-                "title": paper.title,
-                "authors": self.correct_output[paper_id]
-            }
+        if executor is not None:
+            self.collect(executor.map(extract_paper, missing), len(missing), results)
+        elif workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                self.collect(executor.map(extract_paper, missing), len(missing), results)
+        else:
+            self.collect(map(extract_paper, missing), len(missing), results)
+
+        # Merging in the order of the links, so the output doesn't depend on the cache or on the workers
+        for _, paper_id, _, _ in tasks:
+            self.merge(paper_id, *results[paper_id])
 
         return self
 
+    def get_cache_key(self, paper_id):
+        return self.cache.key(f"{self.papers_path}{paper_id}.pdf", f"{self.papers_path}{paper_id}.html")
+
+    def collect(self, results: Iterable[Tuple[str, Optional[Dict], Optional[str], Optional[Stages]]], total: int, output: Dict):
+        for paper_id, paper, error, stages in (pbar := tqdm(results, total=total)):
+            pbar.set_description(f"paper_id={paper_id}")
+
+            if stages is not None:
+                self.timings[paper_id] = stages
+
+            if paper is not None:
+                paper = self.clean(paper)
+
+            output[paper_id] = (paper, error)
+            self.cache.put(self.get_cache_key(paper_id), paper, error)
+
+    def clean(self, paper: Dict) -> Dict:
+        authors = {author: [self.normalise(esta) for esta in establishments] for author, establishments in paper["authors"].items()}
+
+        return {
+            "url": paper["url"],
+            "title": paper["title"],
+            "authors": authors
+        }
+
+    def merge(self, paper_id: str, paper: Optional[Dict], error: Optional[str]):
+        if error is not None:
+            if error in self.errors:
+                self.errors[error].append(paper_id)
+            else:
+                self.errors[error] = [paper_id]
+            return
+
+        self.correct_output[paper_id] = paper
+
     def export(self):
         with open(self.output_path, 'w+') as f:
             json.dump(self.correct_output, f, indent=4)
@@ -86,12 +164,32 @@ class Conference:
         with open(self.errors_path, 'w+') as f:
             json.dump(self.errors, f, indent=4)
 
-    def get_merged_affiliations(self):
-        with open(self.output_path) as f:
-            data = json.load(f)
+        # Same papers as get_merged_affiliations, manually transcribed ones included
+        papers, affiliations = get_tables(self.name, {**self.correct_output, **self.manual})
+        papers.write_parquet(self.papers_table)
+        affiliations.write_parquet(self.affiliations_table)
+
+        # Only when analysed with profile=True
+        if len(self.timings) > 0:
+            with open(f"{self.timings_path}.json", 'w+') as f:
+                json.dump(self.timings, f, indent=4)
 
-        with open(self.manual_path) as f:
-            manual = json.load(f)
+            with open(f"{self.timings_path}.csv", 'w+') as f:
+                writer = csv.writer(f)
+                writer.writerow(["paper_id", "stage", "wall", "cpu", "calls"])
+                writer.writerows(get_rows(self.timings))
+
+            print(summarise(self.timings))
+
+    def profile_paper(self, paper_id) -> str:
+        # Dumps cProfile stats for the extraction of a single paper, to be read with pstats or snakeviz
+        path = f"{self.timings_path}_{paper_id}.prof"
+        cProfile.runctx("extract_paper(task)", globals(), {"task": (self.name, paper_id, self.links[paper_id], False)}, path)
+        return path
+
+    def get_merged_affiliations(self):
+        data = dict(CONTEXT.get_json(self.output_path))
+        manual = CONTEXT.get_json(self.manual_path)
 
         # adding manually transcribed papers
         for key, value in manual.items():
@@ -102,7 +200,7 @@ class Conference:
 
 if __name__ == '__main__':
     conf = Conference("interspeech24")
-    conf.analyse()
+    conf.analyse(workers=os.cpu_count())
     conf.export()
 
     print(conf.correct_output)
@@ -0,0 +1,60 @@
+from typing import Any, Callable, Dict, Optional, Tuple
+import glob
+import json
+import os
+
+import polars as pl
+
+
+def get_stamp(pattern) -> Tuple:
+    # Files matched by a path or a glob pattern, with their modification times and sizes
+    stamp = []
+    for path in sorted(glob.glob(pattern)):
+        stat = os.stat(path)
+        stamp.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(stamp)
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def read_csv(pattern) -> pl.DataFrame:
+    return pl.read_csv(pattern)
+
+
+class DataContext:
+    """
+    Data files shared by the whole pipeline, parsed lazily and only once. A file is parsed again when it changes on
+    disk. Loaded values are shared between callers, so they must not be modified in place.
+    """
+
+    def __init__(self):
+        self.entries: Dict[Tuple[str, Callable], Tuple[Tuple, Any]] = {}
+
+    def load(self, pattern, parser: Callable):
+        stamp = get_stamp(pattern)
+        key = (pattern, parser)
+
+        if len(stamp) > 0 and key in self.entries and self.entries[key][0] == stamp:
+            return self.entries[key][1]
+
+        value = parser(pattern)
+        self.entries[key] = (stamp, value)
+        return value
+
+    def get_json(self, path):
+        return self.load(path, read_json)
+
+    def get_csv(self, pattern) -> pl.DataFrame:
+        return self.load(pattern, read_csv)
+
+    def invalidate(self, pattern: Optional[str] = None):
+        if pattern is None:
+            self.entries = {}
+        else:
+            self.entries = {key: value for key, value in self.entries.items() if key[0] != pattern}
+
+
+CONTEXT = DataContext()
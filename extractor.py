@@ -1,19 +1,93 @@
 import re
-import json
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Set, Tuple
 
-from Levenshtein import distance
-from PIL import Image
-import fitz
-import  pdfquery
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:
+    import sre_constants, sre_parse
 
+from rapidfuzz.distance import Levenshtein
+from rapidfuzz.process import cdist
+
+from context import CONTEXT, read_json
+from layout import PdfPage
+from profiling import timed
+
+
+# Bump whenever a change to the extraction can change its output, so that cached results are recomputed
+EXTRACTOR_VERSION = 4
 
 SEPARATORS = r"\d⋆∗\*‡†♢♣♡♠♥"
 SEPARATORS_SPLIT = r"(\d|⋆|∗|\*|‡|†|♢|♣|♡|♠|♥)"
 
 
-with open("data/postal_codes.json") as f:
-    POSTAL_CODES_REGEX = json.load(f)#set([value for value in json.load(f).values()])
+POSTAL_CODES_PATH = "data/postal_codes.json"
+
+
+def get_required_characters(parsed) -> Tuple[bool, Set[str]]:
+    """
+    Conservative requirements of a parsed regex: whether any match contains a digit, and characters every match
+    contains.
+    """
+    digit, literals = False, set()
+    for op, av in parsed:
+        if op == sre_constants.LITERAL:
+            digit, literals = digit or chr(av).isdigit(), literals | {chr(av)}
+        elif op == sre_constants.IN:
+            digit = digit or all(
+                (o == sre_constants.CATEGORY and a == sre_constants.CATEGORY_DIGIT) or
+                (o == sre_constants.LITERAL and "0" <= chr(a) <= "9") or
+                (o == sre_constants.RANGE and "0" <= chr(a[0]) and chr(a[1]) <= "9")
+                for o, a in av
+            )
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] > 0:
+            d, l = get_required_characters(av[2])
+            digit, literals = digit or d, literals | l
+        elif op == sre_constants.SUBPATTERN:
+            d, l = get_required_characters(av[3])
+            # Inline flags could make literals case insensitive
+            digit, literals = digit or d, literals | (l if av[1] == 0 else set())
+        elif op == sre_constants.BRANCH:
+            branches = [get_required_characters(b) for b in av[1]]
+            digit = digit or all(d for d, _ in branches)
+            literals = literals | set.intersection(*[l for _, l in branches])
+    return digit, literals
+
+
+def compile_postal_codes(regexes: Dict[str, str]) -> List[Tuple[re.Pattern, bool, str]]:
+    compiled = {}
+    for r in regexes.values():
+        # Same pattern for several countries gives the same matches, which the sieve removes anyway
+        if r in compiled:
+            continue
+
+        pattern = re.compile(r)
+        # re.findall gives tuples for patterns with several groups, and those are always discarded
+        if pattern.groups > 1:
+            continue
+
+        digit, literals = get_required_characters(sre_parse.parse(r))
+        if pattern.flags & re.IGNORECASE:
+            literals = set()
+        compiled[r] = (pattern, digit, "".join(sorted(literals)))
+
+    return list(compiled.values())
+
+
+def load_postal_codes(path) -> List[Tuple[re.Pattern, bool, str]]:
+    return compile_postal_codes(read_json(path))
+
+
+DIGITS = re.compile(r"\d")
+
+# Compiled patterns, checked against the file once per paper rather than once per line
+POSTAL_CODES: Optional[List[Tuple[re.Pattern, bool, str]]] = None
+
+
+def reload_postal_codes() -> List[Tuple[re.Pattern, bool, str]]:
+    global POSTAL_CODES
+    POSTAL_CODES = CONTEXT.load(POSTAL_CODES_PATH, load_postal_codes)
+    return POSTAL_CODES
 
 
 def substring_sieve(string_list):
@@ -25,20 +99,28 @@ def substring_sieve(string_list):
     return out
 
 
+@timed("postal_codes")
 def get_postal_codes(line):
+    has_digit = DIGITS.search(line) is not None
+
     matches = []
-    for country, r in POSTAL_CODES_REGEX.items():
-        if match := re.findall(r, line):
+    for pattern, digit, literals in POSTAL_CODES if POSTAL_CODES is not None else reload_postal_codes():
+        # Only trying the patterns that could match this line
+        if (digit and not has_digit) or any(c not in line for c in literals):
+            continue
+        if match := pattern.findall(line):
             matches += match
 
-    matches = [m for m in matches if m != '' and not isinstance(m, tuple)]
+    matches = [m for m in matches if m != '']
 
     return substring_sieve(matches)
 
 
 def find_approximate_substring(line, substring):
-    distances = [(i, distance(line[i:i+len(substring)], substring)) for i in range(0, len(line) - len(substring) + 1)]
-    closest = min(distances, key=lambda x: x[1])[0]
+    # Distances from every window of the line to the substring, computed in a single batched call
+    windows = [line[i:i+len(substring)] for i in range(0, len(line) - len(substring) + 1)]
+    distances = cdist([substring], windows, scorer=Levenshtein.distance)[0].tolist()
+    closest = min(range(len(distances)), key=distances.__getitem__)
     return closest
 
 
@@ -96,27 +178,41 @@ def get_affiliations(raw_line) -> Dict[str, List[str]]:
     return {a: b for a, b in zip(elements, symbols)}
 
 
-def contains_author(line, authors: List[str]) -> bool:
-    for a in authors:
-        if re.search(rf"\b{a}", line):
+class AuthorMatcher:
+    """
+    Line classification against the authors of a paper, with the author names compiled once into single regexes.
+    """
+
+    def __init__(self, authors: List[str]):
+        self.authors = authors
+
+        # Full names, and each of their parts
+        # RISK this would be activated if someone's last name matches a company or lab name
+        names = dict.fromkeys(authors + [b for a in authors for b in a.split(' ')])
+        self.names = re.compile(rf"\b(?:{'|'.join(re.escape(n) for n in names)})") if len(authors) > 0 else None
+
+        emails = dict.fromkeys([a.lower().replace(" ", ".") for a in authors] + [a.lower().replace(" ", "") for a in authors])
+        self.emails = re.compile("|".join(re.escape(e) for e in emails)) if len(authors) > 0 else None
+
+    def contains_author(self, line) -> bool:
+        return self.names is not None and self.names.search(line) is not None
+
+    def is_email(self, line) -> bool:
+        if self.emails is not None and self.emails.search(line) is not None:
             return True
-        for b in a.split(' '):
-            # RISK this would be activated if someone's last name matches a company or lab name
-            if re.search(rf"\b{b}", line) and b in line:
-                return True
-    return False
+
+        return "@" in line and "ASLP@NPU" not in line
 
 
 def is_abstract(line) -> bool:
     return "abstract" in line.lower()
 
 
-def is_email(line, authors: List[str]) -> bool:
-    for a in authors:
-        if a.lower().replace(" ", ".") in line or a.lower().replace(" ", "") in line:
-            return True
-
-    return "@" in line and "ASLP@NPU" not in line
+def stops_above(lines: List[Tuple[List[int], str]], boundary: float) -> bool:
+    for (_, bottom), line in lines:
+        if is_abstract(line):
+            return bottom > boundary
+    return False
 
 
 def is_title(line, title: str) -> bool:
@@ -156,51 +252,49 @@ def split_on_major_gap(lines):
 
 class PaperExtractor:
 
-    def __init__(self, paper_path, paper_title: str, paper_authors):
+    @timed("pdf_load")
+    def __init__(self, paper_path, paper_title: str, paper_authors, header=True):
         self.path = paper_path
         self.paper_title = paper_title
         self.paper_authors = paper_authors
+        self.author_matcher = AuthorMatcher(self.paper_authors)
+        reload_postal_codes()
 
-        # Open the PDF file
-        fitz_pdf = fitz.open(self.path)
+        # Parsing the first page once, for both its size and its text lines, and only above the abstract in header mode
+        self.page = PdfPage(self.path, header=header)
+        self.width, self.height = self.page.width, self.page.height
 
-        # Convert the first page to an image
-        page = fitz_pdf.load_page(0)
-        pixmap = page.get_pixmap(dpi=72)
-        self.image = Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
-        self.width, self.height = self.image.size
+    def get_text_rows(self) -> List[Tuple[List[int], str]]:
+        lines = self.page.get_text_rows()
 
-        # Load pdf for query
-        self.pdf = pdfquery.PDFQuery(self.path)
-        self.pdf.load(0)
+        # The cropped page is only used when the scan is certain to stop on its abstract row, after the titles
+        if self.page.boundary is not None and not stops_above(lines[2:], self.page.boundary):
+            self.page = PdfPage(self.path)
+            lines = self.page.get_text_rows()
 
+        return lines
+
+    @timed("extraction")
     def get_authors_affiliations_locations(self) -> Dict[str, List[str]]:
-        lines: List[Tuple[List[int], str]] = [([0, 0], "")]
-        for h in range(self.height, 0, -1):
-            line = self.pdf.pq(f'LTTextLineHorizontal:overlaps_bbox("{0},{h},{self.width},{h}")').text()
-            if line != "":
-                if lines[-1][1] != line:
-                    lines.append(([h, h], line))
-                else:
-                    lines[-1][0][1] = h
+        lines: List[Tuple[List[int], str]] = self.get_text_rows()
 
-        # Removing first ghost element & conference title & paper title
+        # Removing conference title & paper title
         # Maybe remove lines matching title too much?
-        lines = lines[3:]
+        lines = lines[2:]
 
         interesting_info = []
         establishments = []
         authors_affiliations = []
         found_authors = False
         for nb, line in lines:
-            if contains_author(line, self.paper_authors) and not is_abstract(line) and not is_email(line, self.paper_authors) and not is_title(line, self.paper_title):
+            if self.author_matcher.contains_author(line) and not is_abstract(line) and not self.author_matcher.is_email(line) and not is_title(line, self.paper_title):
                 authors_affiliations.append(line)
                 interesting_info.append((nb, line))
                 found_authors = True
-            elif found_authors and not is_abstract(line) and not is_email(line, self.paper_authors):
+            elif found_authors and not is_abstract(line) and not self.author_matcher.is_email(line):
                 interesting_info.append((nb, line))
                 establishments.append(line)
-            elif is_abstract(line) or is_email(line, self.paper_authors):
+            elif is_abstract(line) or self.author_matcher.is_email(line):
                 break
 
         authors_affiliations, establishments = split_on_major_gap(interesting_info)
@@ -239,8 +333,27 @@ class PaperExtractor:
 
 if __name__ == '__main__':
     import glob
-
-    for path in glob.glob("data/papers/interspeech23/*.pdf"):
-        print(path)
-        PaperExtractor(path).get_authors_affiliations_locations()
-        break
+    import sys
+
+    from layout import query_text_rows
+
+    # Checking the layout index against the row by row pdfquery scan on the cached papers, and the header rows
+    # against the full page rows, up to the row the scan stops on
+    conference = sys.argv[1] if len(sys.argv) > 1 else "interspeech23"
+    mismatches, cropped = [], 0
+    for path in sorted(glob.glob(f"data/papers/{conference}/*.pdf")):
+        extractor = PaperExtractor(path, "", [], header=False)
+        expected = query_text_rows(extractor.page.pdf, extractor.width, extractor.height)
+        if extractor.page.get_text_rows() != expected:
+            mismatches.append(path)
+            print(f"MISMATCH: {path}")
+
+        header = PaperExtractor(path, "", [])
+        rows = header.get_text_rows()
+        cropped += header.page.boundary is not None
+        stop = next((i for i, (_, line) in enumerate(expected) if i >= 2 and is_abstract(line)), len(expected))
+        if rows[:stop + 1] != expected[:stop + 1]:
+            mismatches.append(path)
+            print(f"HEADER MISMATCH: {path}")
+
+    print(f"{len(mismatches)} mismatching papers, {cropped} papers cropped")
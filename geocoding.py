@@ -0,0 +1,126 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
+from pathlib import Path
+import threading
+import json
+import time
+
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+import requests
+
+
+Coordinates = Tuple[Optional[float], Optional[float]]
+
+
+def normalise(lab: str) -> str:
+    return " ".join(lab.lower().split())
+
+
+class GoogleMapsBackend:
+    """
+    Returns the coordinates of a place, (None, None) if the place can't be found, and raises on transient failures
+    so that they are not cached.
+    """
+
+    URL = "https://maps.googleapis.com/maps/api/geocode/json"
+
+    def __init__(self, api_key, url=URL):
+        self.api_key = api_key
+        self.url = url
+
+    def __call__(self, session: requests.Session, place_name: str) -> Coordinates:
+        response = session.get(self.url, params={"address": place_name, "key": self.api_key}, timeout=30)
+        if response.status_code != 200:
+            raise ConnectionError(f"Failed to retrieve data. Status code: {response.status_code}")
+
+        data = response.json()
+        if data['status'] == 'OK':
+            location = data['results'][0]['geometry']['location']
+            return location['lat'], location['lng']
+        elif data['status'] == 'ZERO_RESULTS':
+            return None, None
+        else:
+            raise ConnectionError(f"Geocoding failed. Status: {data['status']}")
+
+
+class RateLimiter:
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self.lock = threading.Lock()
+        self.next = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(self.next, now)
+            self.next = start + self.interval
+        time.sleep(start - now)
+
+
+class Geocoder:
+    """
+    Geocodes labs with a pool of workers under a rate limit. Results are cached on disk by normalised lab name, in a
+    file only ever appended to, so labs already geocoded never hit the network again.
+    """
+
+    CACHE = "data/locations/geocoding.jsonl"
+
+    def __init__(self, backend, cache_path=CACHE, workers=8, rate=20.0, batch_size=50, persist=True):
+        self.backend = backend
+        self.cache_path = cache_path
+        self.workers = workers
+        self.rate_limiter = RateLimiter(rate)
+        self.batch_size = batch_size
+        self.persist = persist
+
+        self.cache: Dict[str, Coordinates] = {}
+        if Path(self.cache_path).exists():
+            with open(self.cache_path) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.cache[entry["key"]] = (entry["latitude"], entry["longitude"])
+
+        self.pending: List[Dict] = []
+
+    def fetch(self, session: requests.Session, lab: str) -> Coordinates:
+        self.rate_limiter.wait()
+        return self.backend(session, lab)
+
+    def flush(self):
+        if self.persist and len(self.pending) > 0:
+            with open(self.cache_path, "a") as f:
+                f.writelines(json.dumps(entry) + "\n" for entry in self.pending)
+        self.pending = []
+
+    def geocode(self, labs: List[str]) -> Dict[str, Coordinates]:
+        missing = {}
+        for lab in labs:
+            if normalise(lab) not in self.cache:
+                missing.setdefault(normalise(lab), lab)
+
+        if len(missing) > 0:
+            with requests.Session() as session, ThreadPoolExecutor(max_workers=self.workers) as executor:
+                adapter = HTTPAdapter(pool_maxsize=self.workers)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+
+                futures = {executor.submit(self.fetch, session, lab): key for key, lab in missing.items()}
+                try:
+                    for future in tqdm(as_completed(futures), total=len(futures)):
+                        key = futures[future]
+                        try:
+                            latitude, longitude = future.result()
+                        except Exception as e:
+                            print(f"Geocoding failed for {missing[key]}: {e}")
+                            continue
+
+                        self.cache[key] = (latitude, longitude)
+                        self.pending.append({"key": key, "lab": missing[key], "latitude": latitude, "longitude": longitude})
+                        if len(self.pending) >= self.batch_size:
+                            self.flush()
+                finally:
+                    self.flush()
+
+        return {lab: self.cache.get(normalise(lab), (None, None)) for lab in labs}
@@ -1,60 +1,30 @@
 from pathlib import Path
-from typing import Tuple, Optional, List
+from typing import Dict, Iterable, Iterator, Tuple, Optional, List, Set
 
 from sklearn.cluster import DBSCAN
+from scipy import sparse
 import numpy as np
-import requests
+import shutil
+import gzip
 import json
 import csv
+import io
+import os
 
 from tqdm import tqdm
 import polars as pl
 from geojson import Feature, Point
 
+from accents import AccentNormaliser
 from conference import Conference
+from context import CONTEXT
+from geocoding import Geocoder, GoogleMapsBackend
 from key import GOOGLE_MAPS_API_KEY
 
 
-def get_location_coordinates(place_name, api_key) -> Tuple[Optional[float], Optional[float]]:
-    url = f"https://maps.googleapis.com/maps/api/geocode/json?address={place_name}&key={api_key}"
-    # print(url)
-    response = requests.get(url)
-    if response.status_code == 200:
-        data = response.json()
-        if data['status'] == 'OK':
-            location = data['results'][0]['geometry']['location']
-            return location['lat'], location['lng']
-        else:
-            print("Geocoding failed. Status:", data['status'])
-            return None, None
-    else:
-        print("Failed to retrieve data. Status code:", response.status_code)
-        return None, None
-
-
 def geocode(locations: List[str], save=True):
-    latitudes, longitudes = {}, {}
-    # latitudes, longitudes = [None for _ in range(len(locations))], [None for _ in range(len(locations))]
-
-    LIMIT = len(locations)
-
-    for loc in tqdm(locations[:LIMIT]):
-        # TODO Make a dictionary to store results AND PRINT THEM!!!
-        try:
-            latitude, longitude = get_location_coordinates(loc, GOOGLE_MAPS_API_KEY)
-            latitudes[loc] = latitude
-            longitudes[loc] = longitude
-
-            if save:
-                with open("output/interspeech23/latitudes.json", "w+") as f:
-                    json.dump(latitudes, f, indent=4)
-
-                with open("output/interspeech23/longitudes.json", "w+") as f:
-                    json.dump(longitudes, f, indent=4)
-        except:
-            continue
-
-    return [(loc, latitudes[loc], longitudes[loc]) for loc in locations]
+    coordinates = Geocoder(GoogleMapsBackend(GOOGLE_MAPS_API_KEY), persist=save).geocode(locations)
+    return [(loc, *coordinates[loc]) for loc in locations]
 
 
 def export(coordinates: List[Tuple[str, float, float]]) -> None:
@@ -67,24 +37,201 @@ def export(coordinates: List[Tuple[str, float, float]]) -> None:
     df.write_csv("output/interspeech23/locations.csv")
 
 
+CRS = {"type": "name", "properties": {"name": "urn:ogc:def:crs:OGC:1.3:CRS84"}}
+
+
+def append_rows(path, rows: List[Tuple]):
+    # Written at once and synced to disk, so an interrupted run keeps every batch appended before it
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+
+    with open(path, "a") as f:
+        f.write(buffer.getvalue())
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def write_feature_collection(path, features: Iterable[Feature], minify=False, members: Optional[Dict] = None):
+    # Streams the features to the file, in the same format as a json.dump of the whole collection
+    separators = (",", ":") if minify else (", ", ": ")
+    item, key = separators
+
+    with open(path, "w+") as f:
+        f.write("{" + json.dumps("type") + key + json.dumps("FeatureCollection"))
+        f.write(item + json.dumps("crs") + key + json.dumps(CRS, separators=separators))
+        f.write(item + json.dumps("features") + key + "[")
+        for i, feature in enumerate(features):
+            if i > 0:
+                f.write(item)
+            f.write(json.dumps(feature, separators=separators))
+        f.write("]")
+
+        for name, value in (members or {}).items():
+            f.write(item + json.dumps(name) + key + json.dumps(value, separators=separators))
+        f.write("}")
+
+
+def write_compressed_copies(path, compression=()):
+    for method in compression:
+        if method == "gzip":
+            with open(path, "rb") as src, gzip.open(f"{path}.gz", "wb", compresslevel=9) as dst:
+                shutil.copyfileobj(src, dst)
+        elif method == "brotli":
+            import brotli
+
+            compressor = brotli.Compressor(quality=11)
+            with open(path, "rb") as src, open(f"{path}.br", "wb") as dst:
+                for chunk in iter(lambda: src.read(1 << 20), b""):
+                    dst.write(compressor.process(chunk))
+                dst.write(compressor.finish())
+        else:
+            raise ValueError(f"Unknown compression: {method}")
+
+
 def jaccard_similarity(list1, list2):
     intersection = len(list(set(list1).intersection(list2)))
     union = (len(set(list1)) + len(set(list2))) - intersection
     return float(intersection) / union
 
 
+def get_incidence(token_lists: List[List[str]], vocabulary: Dict[str, int]) -> sparse.csr_matrix:
+    # Token lists x tokens matrix, the vocabulary being extended with the new tokens
+    indices, indptr = [], [0]
+    for tokens in token_lists:
+        indices += sorted({vocabulary.setdefault(t, len(vocabulary)) for t in tokens})
+        indptr.append(len(indices))
+
+    return sparse.csr_matrix((np.ones(len(indices), dtype=np.int32), indices, indptr), shape=(len(token_lists), len(vocabulary)))
+
+
+def jaccard_distance_matrix(token_lists: List[List[str]], others: Optional[List[List[str]]] = None, radius=1.0,
+                            block_size=1000) -> sparse.csr_matrix:
+    # Jaccard distances of the token lists to the others (themselves by default), for the pairs sharing a token and at
+    # most `radius` apart, by blocks of rows so that memory only grows with the number of close pairs
+    vocabulary = {}
+    incidence = get_incidence(token_lists, vocabulary)
+    other_incidence = incidence if others is None else get_incidence(others, vocabulary)
+    incidence.resize(incidence.shape[0], len(vocabulary))
+    other_incidence.resize(other_incidence.shape[0], len(vocabulary))
+
+    sizes, other_sizes = np.diff(incidence.indptr), np.diff(other_incidence.indptr)
+
+    blocks = []
+    for start in range(0, incidence.shape[0], block_size):
+        intersections = (incidence[start:start + block_size] @ other_incidence.T).tocoo()
+        unions = sizes[start + intersections.row] + other_sizes[intersections.col] - intersections.data
+        distances = 1 - intersections.data / unions
+
+        # Identical token sets are kept as explicit zeros, so they stay neighbours
+        close = distances <= radius
+        blocks.append(sparse.csr_matrix(
+            (distances[close], (intersections.row[close], intersections.col[close])), shape=intersections.shape
+        ))
+
+    if len(blocks) == 0:
+        return sparse.csr_matrix((0, other_incidence.shape[0]))
+    return sparse.vstack(blocks, format="csr")
+
+
+def save_distance_matrix(path, X: sparse.csr_matrix, labels: List[str], radius=1.0):
+    np.savez(path, data=X.data, indices=X.indices, indptr=X.indptr, shape=X.shape, labels=labels, radius=radius)
+
+
+def load_distance_matrix(path) -> Tuple[sparse.csr_matrix, List[str], float]:
+    with np.load(path) as f:
+        X = sparse.csr_matrix((f["data"], f["indices"], f["indptr"]), shape=tuple(f["shape"]))
+        return X, f["labels"].tolist(), float(f["radius"]) if "radius" in f else 1.0
+
+
+def extend_distance_matrix(X: sparse.csr_matrix, labels: List[str], new_labels: List[str], radius=1.0) -> sparse.csr_matrix:
+    # Distances of the new labs to every lab, the distances between the labs already there being kept as they are
+    block = jaccard_distance_matrix(
+        [lab.split(", ") for lab in new_labels], [lab.split(", ") for lab in labels + new_labels], radius
+    )
+    old, new = block[:, :len(labels)], block[:, len(labels):]
+    return sparse.bmat([[X, old.T], [old, new]], format="csr")
+
+
+def load_tables(conferences: Iterable[str]) -> Tuple[pl.DataFrame, pl.DataFrame]:
+    # Papers and affiliations tables written by Conference.export, stacked over several conferences
+    papers, affiliations = [], []
+    for name in conferences:
+        conference = f"{Conference.OUTPUT_DIR}{name}/"
+        papers.append(CONTEXT.load(f"{conference}papers.parquet", pl.read_parquet))
+        affiliations.append(CONTEXT.load(f"{conference}affiliations.parquet", pl.read_parquet))
+
+    return pl.concat(papers), pl.concat(affiliations)
+
+
+class LabIndex:
+    # Existing labs, indexed by their rarest characters only: two labs reaching min_similarity always share one of them
+
+    def __init__(self, existing: pl.DataFrame, min_similarity: float, normalise: Optional[AccentNormaliser] = None):
+        self.min_similarity = min_similarity
+        self.normalise = normalise if normalise is not None else str
+
+        # Coordinates of the first row of each lab, preferring rows with coordinates
+        self.coordinates = {}
+        for lab, latitude, longitude in existing.select("Lab", "Latitude", "Longitude").rows():
+            if lab not in self.coordinates or None in self.coordinates[lab]:
+                self.coordinates[lab] = (latitude, longitude)
+        self.labs = list(self.coordinates.keys())
+        self.names = {}
+        for lab in self.labs:
+            self.names.setdefault(self.normalise(lab), lab)
+        self.characters = [set(self.normalise(lab)) for lab in self.labs]
+
+        self.frequencies = {}
+        for characters in self.characters:
+            for c in characters:
+                self.frequencies[c] = self.frequencies.get(c, 0) + 1
+
+        self.index = {}
+        for position, characters in enumerate(self.characters):
+            for c in self.get_prefix(characters):
+                self.index.setdefault(c, []).append(position)
+
+    def __contains__(self, lab):
+        # Raw names, as the map looks labs up by those, while the coordinates lookups compare normalised names
+        return lab in self.coordinates
+
+    def get_same(self, lab) -> Optional[str]:
+        # First existing lab, in the table order, with the same normalised name
+        return self.names.get(self.normalise(lab))
+
+    def get_prefix(self, characters: Set[str]) -> List[str]:
+        characters = sorted(characters, key=lambda c: (self.frequencies.get(c, 0), c))
+        if self.min_similarity <= 0:
+            return characters
+        return characters[:len(characters) - int(self.min_similarity * len(characters)) + 1]
+
+    def get_similar(self, lab) -> Optional[str]:
+        # First existing lab, in the table order, that is similar enough
+        characters = set(self.normalise(lab))
+        candidates = sorted({position for c in self.get_prefix(characters) for position in self.index.get(c, [])})
+        for position in candidates:
+            # Same value as jaccard_similarity, with the characters of existing labs computed once
+            other = self.characters[position]
+            intersection = len(characters & other)
+            if float(intersection) / (len(characters) + len(other) - intersection) >= self.min_similarity:
+                return self.labs[position]
+        return None
+
+
 class Laboratory:
 
     DIR = "data/locations/"
     CORRECT_OUTPUT = f"{DIR}/locations.csv"
     ALL_LABS_FILE = f"{DIR}/*.csv"
     COORDINATES = "output/{conference}/coordinates.geojson"
+    DISTANCES = "output/jaccard_distances.npz"
+    GROUPS = "output/lab_groups.csv"
 
     def __init__(self, conference: Conference):
         self.conference = conference
-        self.correct = pl.read_csv(Laboratory.CORRECT_OUTPUT)
+        self.correct = CONTEXT.get_csv(Laboratory.CORRECT_OUTPUT)
 
-        self.existing = pl.read_csv(Laboratory.ALL_LABS_FILE)
+        self.existing = CONTEXT.get_csv(Laboratory.ALL_LABS_FILE)
         self.coordinates = Laboratory.COORDINATES.format(conference=conference.name)
 
         self.affiliations = self.conference.get_merged_affiliations()
@@ -97,42 +244,61 @@ class Laboratory:
 
         locations = sorted(set(locations))
 
-        locations = [[loc, None, None] for loc in locations if loc not in self.existing.get_column("Lab")]
-        for i in range(len(locations)):
-            for loc in self.existing.get_column("Lab"):
-                if jaccard_similarity(locations[i][0], loc) >= min_similarity:
-                    locations[i][1] = self.existing.filter(pl.col("Lab") == loc).select("Latitude").item()
-                    locations[i][2] = self.existing.filter(pl.col("Lab") == loc).select("Longitude").item()
-                    break
+        index = LabIndex(self.existing, min_similarity, self.conference.normalise)
+
+        locations = [[loc, None, None] for loc in locations if loc not in index]
+        for location in locations:
+            if (similar := index.get_same(location[0]) or index.get_similar(location[0])) is not None:
+                location[1], location[2] = index.coordinates[similar]
 
         with open(Laboratory.CORRECT_OUTPUT, 'a') as f:
             writer = csv.writer(f)
             writer.writerows(locations)
 
-    def pinpoint(self):
+    def pinpoint(self, incremental=False, batch_size=50):
+        # incremental appends each batch to the table as soon as it is geocoded, instead of rewriting it at the end
         missing_coordinates = self.existing.filter(pl.any_horizontal(pl.all().is_null()))
 
-        for lab in tqdm(missing_coordinates.get_column("Lab")):
-            latitude, longitude = get_location_coordinates(lab, GOOGLE_MAPS_API_KEY)
-
-            row = pl.DataFrame({
-                "Lab": [lab],
-                "Latitude": [latitude],
-                "Longitude": [longitude],
-            })
+        # Labs pinpointed by an earlier incremental run also have a row with coordinates
+        located = set(self.existing.drop_nulls().get_column("Lab").to_list())
+        labs = [lab for lab in dict.fromkeys(missing_coordinates.get_column("Lab").to_list()) if lab not in located]
+
+        geocoder = Geocoder(GoogleMapsBackend(GOOGLE_MAPS_API_KEY))
+
+        if incremental:
+            for i in range(0, len(labs), batch_size):
+                batch = labs[i:i + batch_size]
+                coordinates = geocoder.geocode(batch)
+                append_rows(Laboratory.CORRECT_OUTPUT, [
+                    (lab, *coordinates[lab]) for lab in batch if None not in coordinates[lab]
+                ])
+            return
+
+        coordinates = geocoder.geocode(labs)
+        rows = pl.DataFrame({
+            "Lab": labs,
+            "Latitude": [coordinates[lab][0] for lab in labs],
+            "Longitude": [coordinates[lab][1] for lab in labs],
+        }, schema=self.correct.schema)
+
+        self.correct = pl.concat([self.correct, rows])
+        self.correct.drop_nulls().write_csv(Laboratory.CORRECT_OUTPUT)
 
-            self.correct = self.correct.vstack(row)
+    def get_tables(self) -> Tuple[pl.DataFrame, pl.DataFrame]:
+        return load_tables([self.conference.name])
 
-        self.correct.drop_nulls().write_csv(Laboratory.CORRECT_OUTPUT)
+    def get_lab_papers(self) -> Dict[str, Dict[str, Set[str]]]:
+        # Papers of each lab, with their authors working there, in a single pass over the papers
+        lab_papers = {}
+        for paper_id, paper in self.affiliations.items():
+            for author, aff in paper["authors"].items():
+                for lab in aff:
+                    lab_papers.setdefault(lab, {}).setdefault(paper_id, set()).add(author)
+        return lab_papers
 
-    def export_geojson(self):
-        output = {
-            "type": "FeatureCollection",
-            "crs": {"type": "name", "properties": {"name": "urn:ogc:def:crs:OGC:1.3:CRS84"}},
-            "features": []
-        }
+    def get_features(self, placed_papers: Set[str], paper_table=False) -> Iterator[Feature]:
         locations = self.existing.drop_nulls()
-        placed_papers = set()
+        lab_papers = self.get_lab_papers()
 
         for row in tqdm(locations.rows()):
             coordinates = [float(row[2]), float(row[1])]
@@ -144,17 +310,15 @@ class Laboratory:
             papers = []
 
             # Get papers published from this lab
-            for paper_id, paper in self.affiliations.items():
-                authors_at_location = []
-                other_authors = []
-
-                for author, aff in paper["authors"].items():
-                    if lab in aff:
-                        authors_at_location.append(author)
-                    else:
-                        other_authors.append(author)
-
-                if len(authors_at_location) > 0:
+            for paper_id, authors_at_location in lab_papers.get(lab, {}).items():
+                paper = self.affiliations[paper_id]
+                if paper_table:
+                    # Reference to the papers table, with the positions of the authors working at this lab
+                    papers.append({
+                        "id": paper_id,
+                        "authors": [i for i, author in enumerate(paper["authors"].keys()) if author in authors_at_location],
+                    })
+                else:
                     papers.append({
                         "url": paper["url"],
                         "title": paper["title"],
@@ -163,46 +327,70 @@ class Laboratory:
                                     author in paper["authors"].keys()],
                     })
 
-                    placed_papers.add(paper_id)
+                placed_papers.add(paper_id)
 
             # Checking if the lab has published papers
             if len(papers) > 0:
-                output["features"].append(
-                    Feature(geometry=Point(coordinates), properties={
-                        "title": lab,
-                        "papers": papers
-                    })
-                )
+                yield Feature(geometry=Point(coordinates), properties={
+                    "title": lab,
+                    "papers": papers
+                })
+
+    def export_geojson(self, minify=False, paper_table=False, compression=()):
+        # paper_table stores each paper once in a "papers" member, compression adds "gzip" and/or "brotli" copies
+        placed_papers = set()
+
+        members = {}
+        if paper_table:
+            members["papers"] = {
+                paper_id: {"url": paper["url"], "title": paper["title"], "authors": list(paper["authors"].keys())}
+                for paper_id, paper in self.affiliations.items()
+            }
+
+        write_feature_collection(self.coordinates, self.get_features(placed_papers, paper_table), minify, members)
+        write_compressed_copies(self.coordinates, compression)
 
         for paper_id, paper in self.affiliations.items():
             if paper_id not in placed_papers:
                 print(f"WARNING: {paper_id} will not appear on the map.")
 
-        with open(self.coordinates, "w+") as f:
-            json.dump(output, f)
-
-    def group_lab_names(self, epsilon=0.3):
+    def group_lab_names(self, epsilon=0.3, radius: Optional[float] = None):
+        # With a radius (at least epsilon), only the pairs of labs at most this far apart are stored
         labs = self.existing.select("Lab").to_numpy().tolist()
-        labs = list(set([a[0] for a in labs]))
+        labs = sorted(set([a[0] for a in labs]))
+        radius = 1.0 if radius is None else max(radius, epsilon)
 
-        X = None
-        if Path("output/jaccard_similarity.csv").exists():
-            X = np.loadtxt("output/jaccard_similarity.csv", delimiter=",")
+        # Labs of the matrix rows, in the order they were added to it
+        X, matrix_labs = None, labs
+        if Path(Laboratory.DISTANCES).exists():
+            X, matrix_labs, cached_radius = load_distance_matrix(Laboratory.DISTANCES)
+            if cached_radius < radius or not set(matrix_labs) <= set(labs):
+                X, matrix_labs = None, labs
 
-        if X is None or X.shape != (len(labs), len(labs)):
+        if X is None:
             print("Building distance matrix")
-            X = np.array([[0.0 for _ in labs] for _ in labs])
-            for i, lab_a in tqdm(enumerate(labs), total=len(labs)):
-                for j, lab_b in enumerate(labs[i + 1:]):
-                    similarity = jaccard_similarity(lab_a.split(", "), lab_b.split(", "))
-                    X[i, i + j + 1] = X[i + j + 1, i] = 1 - similarity
-
-            np.savetxt("output/jaccard_similarity.csv", X, delimiter=",")
+            X = jaccard_distance_matrix([lab.split(", ") for lab in labs], radius=radius)
+            save_distance_matrix(Laboratory.DISTANCES, X, labs, radius)
+        elif len(matrix_labs) < len(labs):
+            added = set(matrix_labs)
+            new_labs = [lab for lab in labs if lab not in added]
+            print(f"Adding {len(new_labs)} labs to the distance matrix")
+
+            X = extend_distance_matrix(X, matrix_labs, new_labs, cached_radius)
+            matrix_labs = matrix_labs + new_labs
+            save_distance_matrix(Laboratory.DISTANCES, X, matrix_labs, cached_radius)
         else:
             print("Loaded distance matrix")
 
+        # Clustering the sorted labs, as the result of DBSCAN depends on the order of the samples
+        if matrix_labs != labs:
+            position = {lab: i for i, lab in enumerate(matrix_labs)}
+            order = [position[lab] for lab in labs]
+            X = X[order][:, order]
+
         print(X.shape)
 
+        # Pairs of labs not stored share no name part, or are further apart than the radius: they can't be neighbours
         clustering = DBSCAN(eps=epsilon, min_samples=2, metric='precomputed').fit(X)
         print(np.unique(clustering.labels_))
 
@@ -213,7 +401,7 @@ class Laboratory:
             for lab in np.array(labs)[clustering.labels_ == i]:
                 output.append([i, lab])
 
-        with open("output/lab_groups.csv", 'w+') as f:
+        with open(Laboratory.GROUPS, 'w+') as f:
             writer = csv.writer(f)
             writer.writerows(output)
 
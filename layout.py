@@ -0,0 +1,148 @@
+import math
+import re
+from typing import List, Optional, Tuple
+
+from pdfminer.converter import PDFPageAggregator
+from pdfminer.layout import LTChar, LTPage
+from pdfminer.pdfinterp import PDFPageInterpreter
+import pdfquery
+from pyquery import PyQuery
+
+from profiling import timed
+
+
+# (x0, y0, x1, y1, text) of a single text line, in pdf coordinates (origin at the bottom left of the page)
+TextLine = Tuple[float, float, float, float, str]
+
+
+def get_text_lines(pdf) -> List[TextLine]:
+    # Walking the pdfquery tree once, in document order (the order pdfquery selectors return elements in)
+    return [
+        (float(el.get("x0")), float(el.get("y0")), float(el.get("x1")), float(el.get("y1")), PyQuery(el).text())
+        for el in pdf.tree.iter("LTTextLineHorizontal")
+    ]
+
+
+def get_text_rows(text_lines: List[TextLine], width: int, height: int) -> List[Tuple[List[int], str]]:
+    """
+    Equivalent of querying every horizontal line of the page from the top (h=height) to the bottom (h=1) with
+    `LTTextLineHorizontal:overlaps_bbox("0,h,width,h")`, and merging adjacent rows holding the same text.
+    The set of lines overlapping a row only changes at line boundaries, so each range of rows is resolved once.
+    """
+    spans = []
+    for i, (x0, y0, x1, y1, text) in enumerate(text_lines):
+        if x0 > width or x1 < 0:
+            continue
+
+        top, bottom = min(height, math.floor(y1)), max(1, math.ceil(y0))
+        if bottom <= top:
+            spans.append((top, bottom, i))
+
+    # Rows where the overlapping lines may change, from the top of the page to the bottom
+    starts = sorted({top for top, _, _ in spans} | {bottom - 1 for _, bottom, _ in spans if bottom > 1}, reverse=True)
+
+    rows: List[Tuple[List[int], str]] = []
+    for start, end in zip(starts, starts[1:] + [0]):
+        active = sorted(i for top, bottom, i in spans if bottom <= start <= top)
+        line = " ".join(text_lines[i][4] for i in active)
+
+        if line == "":
+            continue
+
+        if len(rows) > 0 and rows[-1][1] == line:
+            rows[-1][0][1] = end + 1
+        else:
+            rows.append(([start, end + 1], line))
+
+    return rows
+
+
+def query_text_rows(pdf, width: int, height: int) -> List[Tuple[List[int], str]]:
+    # Reference implementation: one pdfquery selector per row of the page
+    rows: List[Tuple[List[int], str]] = []
+    for h in range(height, 0, -1):
+        line = pdf.pq(f'LTTextLineHorizontal:overlaps_bbox("{0},{h},{width},{h}")').text()
+        if line != "":
+            if len(rows) == 0 or rows[-1][1] != line:
+                rows.append(([h, h], line))
+            else:
+                rows[-1][0][1] = h
+    return rows
+
+
+ABSTRACT = re.compile("abstract", re.IGNORECASE)
+
+
+def get_header_boundary(page: LTPage) -> Optional[float]:
+    # Height one line below the first "Abstract" of the page, in the order the characters are drawn
+    chars = [obj for obj in page if isinstance(obj, LTChar)]
+
+    offsets, text = [], ""
+    for char in chars:
+        offsets.append(len(text))
+        text += char.get_text()
+
+    if (match := ABSTRACT.search(text)) is None:
+        return None
+
+    keyword = [char for char, offset in zip(chars, offsets) if match.start() <= offset < match.end()]
+    return min(char.y0 for char in keyword) - max(char.height for char in keyword)
+
+
+class HeaderAggregator(PDFPageAggregator):
+    """
+    Lays out only the header of the page: the objects drawn below the first "Abstract" are dropped before the layout
+    analysis, and so never become part of the pdfquery tree. The whole page is laid out when there is no "Abstract".
+    """
+
+    def __init__(self, rsrcmgr, pageno=1, laparams=None):
+        super().__init__(rsrcmgr, pageno=pageno, laparams=laparams)
+        self.boundary: Optional[float] = None
+
+    def end_page(self, page):
+        self.boundary = get_header_boundary(self.cur_item)
+        if self.boundary is not None:
+            self.cur_item._objs = [obj for obj in self.cur_item if obj.y1 >= self.boundary]
+        super().end_page(page)
+
+
+class PdfPage:
+    """
+    Single pdf session for one page of a paper: the page is parsed once, and supplies both its geometry and its
+    text lines. Nothing is rendered unless an image is explicitly requested.
+
+    With `header`, only the text above the abstract is parsed, and `boundary` is the height the page was cropped at
+    (None when it wasn't).
+    """
+
+    def __init__(self, path, page_number=0, header=False):
+        self.path = path
+        self.page_number = page_number
+
+        self.pdf = pdfquery.PDFQuery(self.path)
+        if header:
+            device = self.pdf.device
+            self.pdf.device = HeaderAggregator(device.rsrcmgr, laparams=device.laparams)
+            self.pdf.interpreter = PDFPageInterpreter(device.rsrcmgr, self.pdf.device)
+        self.pdf.load(self.page_number)
+        self.boundary: Optional[float] = self.pdf.device.boundary if header else None
+
+        # Same size as a 72 dpi rendering of the page
+        page = self.pdf.tree.find(".//LTPage")
+        self.width = math.ceil(float(page.get("width")))
+        self.height = math.ceil(float(page.get("height")))
+
+    def get_text_lines(self) -> List[TextLine]:
+        return get_text_lines(self.pdf)
+
+    @timed("line_scan")
+    def get_text_rows(self) -> List[Tuple[List[int], str]]:
+        return get_text_rows(self.get_text_lines(), self.width, self.height)
+
+    @timed("render")
+    def get_image(self, dpi=72):
+        import fitz
+        from PIL import Image
+
+        pixmap = fitz.open(self.path).load_page(self.page_number).get_pixmap(dpi=dpi)
+        return Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
@@ -0,0 +1,98 @@
+from html.parser import HTMLParser
+from typing import Dict, List, Optional, Tuple
+from pathlib import Path
+import json
+import os
+import re
+
+
+Reference = Tuple[List[str], str]
+
+HEAD_END = re.compile(r"</head\s*>", re.IGNORECASE)
+
+
+class MetaParser(HTMLParser):
+
+    def __init__(self):
+        super().__init__()
+        self.metas: List[Dict[str, str]] = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "meta":
+            # Same as BeautifulSoup: the last duplicated attribute wins, and attributes without a value are empty
+            self.metas.append({name: "" if value is None else value for name, value in attrs})
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+
+    def get_contents(self, name) -> List[str]:
+        return [meta["content"] for meta in self.metas if meta.get("name") == name]
+
+
+def read_reference(page: str) -> Reference:
+    """
+    Authors and title from the citation meta tags of a paper landing page. Only the head of the page is parsed, unless
+    the title isn't in it.
+    """
+    parser = MetaParser()
+
+    if (end := HEAD_END.search(page)) is not None:
+        parser.feed(page[:end.end()])
+        if len(parser.get_contents("citation_title")) == 0:
+            parser.feed(page[end.end():])
+    else:
+        parser.feed(page)
+    parser.close()
+
+    authors = [" ".join(content.split(",")[::-1]).strip() for content in parser.get_contents("citation_author")]
+    title = parser.get_contents("citation_title")[0]
+
+    return authors, title
+
+
+def get_stamp(path) -> List[int]:
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+class MetadataStore:
+    """
+    Authors and titles read from the landing pages of a conference, kept in a file only ever appended to, so that each
+    page is parsed once. An entry is only used while the page it was read from is unchanged on disk.
+    """
+
+    FILE = "metadata.jsonl"
+
+    stores: Dict[str, "MetadataStore"] = {}
+
+    def __init__(self, folder):
+        self.path = f"{folder}{MetadataStore.FILE}"
+
+        self.entries: Dict[str, Dict] = {}
+        if Path(self.path).exists():
+            with open(self.path) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.entries[entry["id"]] = entry
+
+    @staticmethod
+    def get_store(folder) -> "MetadataStore":
+        # One store per folder and per process, loaded on first use
+        if folder not in MetadataStore.stores:
+            MetadataStore.stores[folder] = MetadataStore(folder)
+        return MetadataStore.stores[folder]
+
+    def get(self, paper_id, page_path) -> Optional[Reference]:
+        entry = self.entries.get(paper_id)
+        if entry is None or entry["stamp"] != get_stamp(page_path):
+            return None
+        return entry["authors"], entry["title"]
+
+    def put(self, paper_id, page_path, reference: Reference):
+        authors, title = reference
+        entry = {"id": paper_id, "stamp": get_stamp(page_path), "title": title, "authors": authors}
+        self.entries[paper_id] = entry
+
+        # A single write of a whole line, so that workers appending concurrently don't interleave
+        with open(self.path, "ab") as f:
+            f.write((json.dumps(entry) + "\n").encode())
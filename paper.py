@@ -1,18 +1,46 @@
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 from pathlib import Path
 import requests
 import json
 import os
 
-from Levenshtein import distance
-from bs4 import BeautifulSoup
+from bs4 import UnicodeDammit
+from rapidfuzz.distance import Levenshtein
+from rapidfuzz.process import cdist
+from scipy.optimize import linear_sum_assignment
 from tqdm import tqdm
 
 from extractor import PaperExtractor
+from metadata import MetadataStore, read_reference
+from profiling import timed
 
-def get_closest_from_list(initial: str, targets: List[str]):
-    distances = [distance(initial, t) for t in targets]
-    return targets[distances.index(min(distances))]
+def write_atomic(path, content: bytes):
+    # Writing to a temporary file first, so that an interrupted download never leaves a truncated file behind
+    temporary = f"{path}.part"
+    with open(temporary, "wb") as f:
+        f.write(content)
+    os.replace(temporary, path)
+
+
+def assign_closest(initials: List[str], targets: List[str]) -> List[Optional[str]]:
+    """
+    Closest target of each initial name, each target being given at most once. Names keep their closest target (the
+    first one on ties) when they all differ, and otherwise the assignment minimising the total distance is used. Names
+    left without a target, when there are fewer targets than names, get None.
+    """
+    if len(initials) == 0 or len(targets) == 0:
+        return [None] * len(initials)
+
+    distances = cdist(initials, targets, scorer=Levenshtein.distance)
+
+    closest = distances.argmin(axis=1)
+    if len(set(closest.tolist())) == len(initials):
+        return [targets[j] for j in closest]
+
+    assigned: List[Optional[str]] = [None] * len(initials)
+    for i, j in zip(*linear_sum_assignment(distances)):
+        assigned[i] = targets[j]
+    return assigned
 
 
 class Paper:
@@ -32,6 +60,7 @@ class Paper:
         self.authors_affiliations = self.get_authors_affiliations()
         self.fix_authors_names_from_reference()
 
+    @timed("download")
     def download(self):
         # Send a GET request to the URL
         response = requests.get(self.url)
@@ -39,27 +68,29 @@ class Paper:
         # Check if the request was successful (status code 200)
         if response.status_code == 200:
             # Save the PDF to the specified folder
-            with open(self.path, "wb") as f:
-                f.write(response.content)
+            write_atomic(self.path, response.content)
         else:
             raise ImportError(f"Failed to download: {self.url} (status-code={response.status_code})")
 
+    @timed("get_reference")
     def get_reference(self) -> Tuple[List[str], str]:
+        store = MetadataStore.get_store(f"{Paper.FOLDER}{self.event}/")
+
         if os.path.exists(self.page_path):
+            if (reference := store.get(self.name, self.page_path)) is not None:
+                return reference
+
             with open(self.page_path, "r") as f:
-                soup = BeautifulSoup(f.read(), "html.parser")
+                reference = read_reference(f.read())
         else:
             page = requests.get(self.page_url)
 
-            with open(self.page_path, "wb+") as f:
-                f.write(page.content)
+            write_atomic(self.page_path, page.content)
 
-            soup = BeautifulSoup(page.content, "html.parser")
+            reference = read_reference(UnicodeDammit(page.content).unicode_markup)
 
-        authors = [" ".join(meta["content"].split(",")[::-1]).strip() for meta in soup.findAll("meta", attrs={"name": "citation_author"})]
-        title = soup.findAll("meta", attrs={"name": "citation_title"})[0]["content"]
-
-        return authors, title
+        store.put(self.name, self.page_path, reference)
+        return reference
 
     def get_path(self):
         if os.path.exists(self.path):
@@ -71,10 +102,14 @@ class Paper:
     def get_authors_affiliations(self):
         return PaperExtractor(self.get_path(), self.title, self.authors_reference).get_authors_affiliations_locations()
 
+    @timed("fix_names")
     def fix_authors_names_from_reference(self):
+        authors = list(self.authors_affiliations.keys())
+
         output = {}
-        for author in self.authors_affiliations.keys():
-            output[get_closest_from_list(author, self.authors_reference)] = self.authors_affiliations[author]
+        for author, reference in zip(authors, assign_closest(authors, self.authors_reference)):
+            if reference is not None:
+                output[reference] = self.authors_affiliations[author]
         self.authors_affiliations = output
 
         if len(self.authors_affiliations) != len(self.authors_reference):
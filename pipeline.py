@@ -0,0 +1,112 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, List
+from pathlib import Path
+import multiprocessing
+import threading
+import hashlib
+import json
+import os
+
+from conference import Conference
+from context import get_stamp
+from extractor import EXTRACTOR_VERSION
+from laboratory import Laboratory
+from prefetch import Prefetcher
+
+
+class Pipeline:
+    """
+    Runs every stage for a list of conferences: prefetch -> analyse -> labs -> pinpoint -> geojson.
+
+    A stage is skipped when the files it reads and writes are the same as after its last run, so adding a
+    conference only costs the work for that conference. Conferences are downloaded and analysed concurrently, sharing
+    a single pool of extraction processes.
+    """
+
+    STATE = "output/pipeline.json"
+
+    def __init__(self, conferences: List[str], workers=os.cpu_count(), force=False):
+        self.conferences = conferences
+        self.workers = workers
+        self.force = force
+
+        self.state = {}
+        if Path(Pipeline.STATE).exists():
+            with open(Pipeline.STATE) as f:
+                self.state = json.load(f)
+
+        self.lock = threading.Lock()
+
+    def get_stamp(self, files: List[str], version="") -> str:
+        h = hashlib.sha256(version.encode())
+        for pattern in files:
+            h.update(repr(get_stamp(pattern)).encode())
+        return h.hexdigest()
+
+    def run_stage(self, name: str, files: List[str], stage: Callable, version=""):
+        if not self.force and self.state.get(name) == self.get_stamp(files, version):
+            print(f"Skipping {name}: unchanged")
+            return
+
+        print(f"Running {name}")
+        stage()
+
+        # Files as left by the stage, so that its own outputs don't trigger it again
+        with self.lock:
+            self.state[name] = self.get_stamp(files, version)
+            with open(Pipeline.STATE, "w+") as f:
+                json.dump(self.state, f, indent=4)
+
+    def get_conference_files(self, name) -> List[str]:
+        return [
+            f"{Conference.CONFERENCES_DIR}{name}.json",
+            f"{Conference.PAPERS_DIR}{name}.json",
+            f"{Conference.OUTPUT_DIR}{name}/general.json",
+        ]
+
+    def prepare(self, name, executor: ProcessPoolExecutor):
+        self.run_stage(f"{name}/prefetch", [
+            f"{Conference.CONFERENCES_DIR}{name}.json",
+            f"{Conference.PAPERS_DIR}{name}/*",
+        ], lambda: Prefetcher(name).run())
+
+        self.run_stage(f"{name}/analyse", [
+            f"{Conference.CONFERENCES_DIR}{name}.json",
+            f"{Conference.PAPERS_DIR}{name}.json",
+            f"{Conference.PAPERS_DIR}{name}/*",
+            "data/accents.json",
+            "data/postal_codes.json",
+            f"{Conference.OUTPUT_DIR}{name}/general.json",
+            f"{Conference.OUTPUT_DIR}{name}/errors.json",
+            f"{Conference.OUTPUT_DIR}{name}/papers.parquet",
+            f"{Conference.OUTPUT_DIR}{name}/affiliations.parquet",
+        ], lambda: Conference(name).analyse(executor=executor).export(), version=str(EXTRACTOR_VERSION))
+
+    def run(self):
+        # Forked processes don't mix well with the threads running the conferences
+        context = multiprocessing.get_context("forkserver")
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as executor, \
+                ThreadPoolExecutor(max_workers=len(self.conferences)) as threads:
+            for future in [threads.submit(self.prepare, name, executor) for name in self.conferences]:
+                future.result()
+
+        # Labs from every conference go to the same locations table, one conference at a time. The table itself is
+        # not an input: it is rewritten by pinpoint, and adding labs to it by hand only leaves less to export.
+        labs_files = [f for name in self.conferences for f in self.get_conference_files(name)]
+        self.run_stage("labs", labs_files, lambda: [
+            Laboratory(Conference(name)).export() for name in self.conferences
+        ])
+
+        self.run_stage("pinpoint", [Laboratory.ALL_LABS_FILE], lambda: Laboratory(Conference(self.conferences[0])).pinpoint())
+
+        for name in self.conferences:
+            self.run_stage(f"{name}/geojson", self.get_conference_files(name) + [
+                Laboratory.ALL_LABS_FILE,
+                Laboratory.COORDINATES.format(conference=name),
+            ], lambda: Laboratory(Conference(name)).export_geojson())
+
+
+if __name__ == '__main__':
+    import sys
+
+    Pipeline(sys.argv[1:] or ["interspeech23", "interspeech24"]).run()
@@ -0,0 +1,121 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+from pathlib import Path
+import asyncio
+import json
+import os
+
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+import requests
+
+from conference import Conference
+from paper import Paper, write_atomic
+
+
+class RetryableError(Exception):
+    pass
+
+
+def download(session: requests.Session, url: str, path: str, timeout: float):
+    try:
+        response = session.get(url, timeout=timeout)
+    except requests.RequestException as e:
+        raise RetryableError(f"Failed to download: {url} ({e.__class__.__name__})")
+
+    if response.status_code == 200:
+        write_atomic(path, response.content)
+    elif response.status_code == 429 or response.status_code >= 500:
+        raise RetryableError(f"Failed to download: {url} (status-code={response.status_code})")
+    else:
+        raise ImportError(f"Failed to download: {url} (status-code={response.status_code})")
+
+
+class Prefetcher:
+    """
+    Fills data/papers/{conference_name}/ with the pdf file and the html page of every paper listed in
+    data/conferences/{conference_name}.json, skipping the files already downloaded.
+    """
+
+    def __init__(self, name, concurrency=8, retries=3, backoff=0.5, timeout=30.0):
+        self.name = name
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.papers_path = f"{Conference.PAPERS_DIR}{name}/"
+        self.links_path = f"{Conference.CONFERENCES_DIR}{name}.json"
+
+        Path(self.papers_path).mkdir(parents=True, exist_ok=True)
+
+        with open(self.links_path) as f:
+            self.links = json.load(f)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.downloaded = 0
+        self.cached = 0
+        self.errors = {}
+
+    def get_files(self) -> List[Tuple[str, str, str]]:
+        files = []
+        for paper_id, link in self.links.items():
+            path = f"{Paper.FOLDER}{self.name}/{paper_id}.pdf"
+            files.append((paper_id, link, path))
+            files.append((paper_id, link.replace(".pdf", ".html"), path.replace(".pdf", ".html")))
+        return files
+
+    async def fetch(self, semaphore: asyncio.Semaphore, paper_id: str, url: str, path: str):
+        if os.path.exists(path):
+            self.cached += 1
+            return
+
+        async with semaphore:
+            for attempt in range(self.retries + 1):
+                try:
+                    await asyncio.to_thread(download, self.session, url, path, self.timeout)
+                    self.downloaded += 1
+                    return
+                except RetryableError as e:
+                    error = e
+                except ImportError as e:
+                    error = e
+                    break
+
+                if attempt < self.retries:
+                    await asyncio.sleep(self.backoff * 2 ** attempt)
+
+        k = str(error)
+        if k in self.errors:
+            self.errors[k].append(paper_id)
+        else:
+            self.errors[k] = [paper_id]
+
+    async def fetch_all(self):
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=self.concurrency))
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = [self.fetch(semaphore, *file) for file in self.get_files()]
+        for task in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc=self.name):
+            await task
+
+    def run(self) -> Dict[str, List[str]]:
+        try:
+            asyncio.run(self.fetch_all())
+        finally:
+            self.session.close()
+
+        return self.errors
+
+
+if __name__ == '__main__':
+    import sys
+
+    for conf in sys.argv[1:] or ["interspeech23", "interspeech24"]:
+        prefetcher = Prefetcher(conf)
+        errors = prefetcher.run()
+        print(f"{conf}: {prefetcher.downloaded} downloaded, {prefetcher.cached} already cached")
+        print(errors)
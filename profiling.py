@@ -0,0 +1,75 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+import functools
+import time
+
+
+Stages = Dict[str, Dict[str, float]]
+
+RECORDER: ContextVar[Optional[Stages]] = ContextVar("recorder", default=None)
+
+
+@contextmanager
+def recording():
+    # Collects the time spent in every stage run within the block, in this thread only
+    stages: Stages = {}
+    token = RECORDER.set(stages)
+    try:
+        yield stages
+    finally:
+        RECORDER.reset(token)
+
+
+@contextmanager
+def stage(name: str):
+    stages = RECORDER.get()
+    if stages is None:
+        yield
+        return
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        record = stages.setdefault(name, {"wall": 0.0, "cpu": 0.0, "calls": 0})
+        record["wall"] += time.perf_counter() - wall
+        record["cpu"] += time.process_time() - cpu
+        record["calls"] += 1
+
+
+def timed(name: str):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_rows(timings: Dict[str, Stages]) -> List[List]:
+    return [
+        [paper_id, name, record["wall"], record["cpu"], record["calls"]]
+        for paper_id, stages in timings.items() for name, record in stages.items()
+    ]
+
+
+def summarise(timings: Dict[str, Stages], top=10) -> str:
+    totals: Stages = {}
+    for stages in timings.values():
+        for name, record in stages.items():
+            total = totals.setdefault(name, {"wall": 0.0, "cpu": 0.0, "calls": 0})
+            for k in total:
+                total[k] += record[k]
+
+    lines = [f"{len(timings)} papers", "Stages (total wall / cpu time, calls):"]
+    for name, total in sorted(totals.items(), key=lambda x: -x[1]["wall"]):
+        lines.append(f"  {name}: {total['wall']:.2f}s / {total['cpu']:.2f}s, {total['calls']}")
+
+    lines.append("Slowest papers:")
+    slowest = sorted(timings.items(), key=lambda x: -x[1].get("paper", {"wall": 0.0})["wall"])[:top]
+    for paper_id, stages in slowest:
+        lines.append(f"  {paper_id}: {stages.get('paper', {'wall': 0.0})['wall']:.2f}s")
+
+    return "\n".join(lines)